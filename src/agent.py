@@ -1,7 +1,11 @@
 """
 Agent模块，实现银行客服智能体
 """
-from typing import Dict, Any, List, Tuple, Optional, TypedDict, Union
+import asyncio
+import json
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, Optional, TypedDict, Union, AsyncIterator
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
 from langsmith.run_helpers import traceable
 from langsmith import Client
@@ -10,45 +14,140 @@ from loguru import logger
 from src.tools import RAGTool, ModelTool, WebSearchTool
 from src.config import LANGCHAIN_PROJECT
 
+# 提供给模型的函数调用定义；未调用任何工具即表示由模型直接回答 (MODEL)
+TOOL_SCHEMAS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "query_knowledge_base",
+            "description": "查询银行知识库文档，适用于标准业务流程（开户、贷款等）、固定政策信息（利率、费率等）、产品详细说明（理财、信用卡等）和内部规章制度",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "用于检索知识库的问题"}
+                },
+                "required": ["query"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "web_search",
+            "description": "进行网络搜索，适用于最新市场信息、实时金融数据（汇率等）和最新政策变化",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "搜索关键词"}
+                },
+                "required": ["query"]
+            }
+        }
+    }
+]
+
+# 函数名到工具类型的映射
+TOOL_NAMES = {
+    "query_knowledge_base": "RAG",
+    "web_search": "SEARCH",
+}
+
+# 工具选择的静态指令，作为 system 消息保持不变
+ANALYZE_SYSTEM_PROMPT = """你是一个专业的银行客服助手。请分析用户的当前查询，判断是否需要调用工具来回答：
+- 需要银行业务流程、政策、产品说明或内部规章时，调用 query_knowledge_base
+- 需要最新市场信息、实时金融数据或最新政策变化时，调用 web_search
+- 两类信息都需要时，可以同时调用两个工具
+- 需要推理、建议、个性化咨询或简单解释的问题，请直接用专业、友好的语气回答，不要调用工具"""
+
+# 生成最终回答的静态指令
+RESPONSE_SYSTEM_PROMPT = """你是一个专业的银行客服助手。请基于用户问题和工具结果生成专业、友好的银行客服回答，并确保回答：
+1. 专业且准确
+2. 语气友好
+3. 结构清晰
+4. 考虑对话上下文
+5. 如有必要，提供后续建议"""
+
+# 处理失败时返回给用户的提示
+ERROR_RESPONSE = "抱歉，处理您的请求时出现了错误。请稍后再试或联系人工客服。"
+
+# 对话历史窗口（消息条数），历史增长到 2 倍后将较早的消息压缩为摘要
+HISTORY_WINDOW = 4
+
 class AgentState(TypedDict):
     """智能体状态类型定义"""
     query: str
-    chat_history: List[Dict[str, str]]  # 添加对话历史
     tool_choice: Optional[str]
+    tool_calls: List[Tuple[str, str]]  # (工具类型, 工具查询) 列表
     tool_result: Optional[str]
     response: Optional[str]
 
+def _node(method_name: str):
+    """创建工作流节点，运行时从配置中取出智能体实例并调用其同名方法"""
+    async def node(state: AgentState, config: RunnableConfig) -> AgentState:
+        agent = config["configurable"]["agent"]
+        return await getattr(agent, method_name)(state)
+    
+    node.__name__ = method_name
+    return node
+
 class BankServiceAgent:
     """银行客服智能体"""
     
-    def __init__(self):
-        self.rag_tool = RAGTool()
-        self.model_tool = ModelTool()
-        self.web_search_tool = WebSearchTool()
-        self.workflow = self._create_workflow()
+    def __init__(
+        self,
+        rag_tool: Optional[RAGTool] = None,
+        model_tool: Optional[ModelTool] = None,
+        web_search_tool: Optional[WebSearchTool] = None
+    ):
+        # 工具可由调用方注入，便于在多个会话之间共享模型和连接
+        self.rag_tool = rag_tool or RAGTool()
+        self.model_tool = model_tool or ModelTool()
+        self.web_search_tool = web_search_tool or WebSearchTool()
+        # 工作流结构与实例无关，编译结果在类级别共享，这里只绑定当前实例
+        binding = {"configurable": {"agent": self}}
+        self.workflow = self._get_workflow().with_config(binding)
+        # 流式输出时只执行到工具结果，最终回答由 chat_stream 逐段生成
+        self.tool_workflow = self._get_workflow(with_response=False).with_config(binding)
         self.client = Client()  # LangSmith 客户端
         self.chat_history = []  # 存储对话历史
+        self.history_str = ""  # 格式化后的对话历史，写入时更新，读取时直接使用
+        self.summary = ""  # 移出窗口的早期对话摘要
+        # 初始状态模板，对话历史由各节点通过 self 访问，不放入状态中
+        self._state_template: AgentState = {
+            "query": "",
+            "tool_choice": None,
+            "tool_calls": [],
+            "tool_result": None,
+            "response": None
+        }
     
-    def _create_workflow(self) -> StateGraph:
-        """创建工作流程图"""
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_workflow(cls, with_response: bool = True) -> StateGraph:
+        """创建并编译工作流程图，同一结构在进程内只编译一次
+        
+        Args:
+            with_response: 是否包含生成最终回答的节点
+        """
         # 定义工作流
         workflow = StateGraph(AgentState)
         
         # 定义节点
-        workflow.add_node("analyze_query", self._analyze_query)
-        workflow.add_node("use_rag", self._use_rag)
-        workflow.add_node("use_model", self._use_model)
-        workflow.add_node("use_web_search", self._use_web_search)
-        workflow.add_node("generate_response", self._generate_response)
+        workflow.add_node("analyze_query", _node("_analyze_query"))
+        workflow.add_node("dispatch_tool", _node("_dispatch_tool"))
+        response_node = END
+        if with_response:
+            workflow.add_node("generate_response", _node("_generate_response"))
+            workflow.add_edge("generate_response", END)
+            response_node = "generate_response"
         
-        # 定义边
-        workflow.add_edge("analyze_query", "use_rag")
-        workflow.add_edge("analyze_query", "use_model")
-        workflow.add_edge("analyze_query", "use_web_search")
-        workflow.add_edge("use_rag", "generate_response")
-        workflow.add_edge("use_model", "generate_response")
-        workflow.add_edge("use_web_search", "generate_response")
-        workflow.add_edge("generate_response", END)
+        # 定义边：模型直接回答时跳过工具节点，只有存在工具调用时才进入 dispatch_tool
+        workflow.add_conditional_edges(
+            "analyze_query",
+            cls._route_tool,
+            {"dispatch_tool": "dispatch_tool", "generate_response": response_node}
+        )
+        workflow.add_edge("dispatch_tool", response_node)
         
         # 设置工作流的入口节点
         workflow.set_entry_point("analyze_query")
@@ -57,137 +156,151 @@ class BankServiceAgent:
         return workflow.compile()
     
     @traceable(name="analyze_query", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def _analyze_query(self, state: AgentState) -> AgentState:
-        """分析用户查询，决定使用哪个工具"""
+    async def _analyze_query(self, state: AgentState) -> AgentState:
+        """分析用户查询：模型直接回答，或通过函数调用返回需要执行的工具"""
         query = state["query"]
         
-        # 构建包含历史上下文的提示词
-        context = "之前的对话：\n"
-        if self.chat_history:
-            for msg in self.chat_history[-3:]:  # 只使用最近的3轮对话作为上下文
-                context += f"{msg['role']}: {msg['content']}\n"
+        # 静态指令放在 system 消息中，变化的对话上下文和当前查询只出现在末尾，
+        # 使每次请求的前缀保持一致，便于命中服务端的提示词缓存
+        prompt = f"之前的对话：\n{self.history_str}当前查询: {query}"
         
-        # 调用模型来决定使用哪个工具
-        prompt = f"""
-        请分析以下用户查询，并决定使用哪个工具来回答。
-
-        {context}
-        当前查询: {query}
-
-        可用工具及其使用场景:
-        1. 知识库文档 (RAG)
-           - 银行标准业务流程（开户、贷款等）
-           - 固定政策信息（利率、费率等）
-           - 产品详细说明（理财、信用卡等）
-           - 内部规章制度
-           适用问题示例：
-           - "办理房贷需要什么材料？"
-           - "你们银行有哪些理财产品？"
-
-        2. 模型直接回答 (MODEL)
-           - 需要推理或建议的问题
-           - 个性化咨询
-           - 简单的解释说明
-           适用问题示例：
-           - "我应该选择哪种理财产品？"
-           - "如何提高信用卡额度？"
-
-        3. 网络搜索 (SEARCH)
-           - 需要最新市场信息
-           - 实时金融数据
-           - 最新政策变化
-           适用问题示例：
-           - "今天的美元汇率是多少？"
-           - "最近的存款利率政策有什么变化？"
-
-        请根据问题特点和对话上下文选择最合适的工具，只返回: RAG, MODEL, 或 SEARCH
-        """
+        message = await self.model_tool.query_with_tools(prompt, TOOL_SCHEMAS, system=ANALYZE_SYSTEM_PROMPT)
         
-        tool_choice = self.model_tool.query(prompt).strip().upper()
-        state["tool_choice"] = tool_choice
-        state["chat_history"] = self.chat_history
-        return state
-    
-    @traceable(name="use_rag", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def _use_rag(self, state: AgentState) -> Optional[AgentState]:
-        """使用RAG工具"""
-        if state["tool_choice"] != "RAG":
-            return None
+        tool_calls = []
+        for tool_call in message.tool_calls or []:
+            tool_choice = TOOL_NAMES.get(tool_call.function.name)
+            if tool_choice is None:
+                logger.warning(f"无法识别的工具调用: {tool_call.function.name}")
+                continue
+            try:
+                arguments = json.loads(tool_call.function.arguments or "{}")
+            except json.JSONDecodeError:
+                arguments = {}
+            tool_calls.append((tool_choice, arguments.get("query") or query))
         
-        result = self.rag_tool.query(state["query"])
-        state["tool_result"] = result
+        if tool_calls:
+            state["tool_choice"] = "+".join(choice for choice, _ in tool_calls)
+        else:
+            # 未调用工具时，模型的回复即为直接回答，省去一次额外的模型调用
+            state["tool_choice"] = "MODEL"
+            state["tool_result"] = message.content
+        state["tool_calls"] = tool_calls
         return state
     
-    @traceable(name="use_model", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def _use_model(self, state: AgentState) -> Optional[AgentState]:
-        """使用模型工具"""
-        if state["tool_choice"] != "MODEL":
-            return None
-        
-        result = self.model_tool.query(state["query"])
-        state["tool_result"] = result
-        return state
+    @staticmethod
+    def _route_tool(state: AgentState) -> str:
+        """根据是否存在工具调用选择下一个节点"""
+        return "dispatch_tool" if state["tool_calls"] else "generate_response"
     
-    @traceable(name="use_web_search", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def _use_web_search(self, state: AgentState) -> Optional[AgentState]:
-        """使用网络搜索工具"""
-        if state["tool_choice"] != "SEARCH":
-            return None
+    async def _dispatch_tool(self, state: AgentState) -> AgentState:
+        """并发执行模型返回的工具调用（各工具自身已有追踪，这里不再单独记录）"""
+        tool_calls = state["tool_calls"]
+        tools = {
+            "RAG": self.rag_tool.query,
+            "SEARCH": self.web_search_tool.search,
+        }
+        # 多个工具并发执行，总耗时取决于最慢的工具而不是各工具之和
+        results = await asyncio.gather(*[
+            tools[tool_choice](tool_query)
+            for tool_choice, tool_query in tool_calls
+        ])
         
-        result = self.web_search_tool.search(state["query"])
-        state["tool_result"] = result
+        if len(results) == 1:
+            state["tool_result"] = results[0]
+        else:
+            state["tool_result"] = "\n\n".join(
+                f"[{tool_choice}]\n{result}"
+                for (tool_choice, _), result in zip(tool_calls, results)
+            )
         return state
     
     @traceable(name="generate_response", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def _generate_response(self, state: AgentState) -> AgentState:
+    async def _generate_response(self, state: AgentState) -> AgentState:
         """生成最终响应"""
-        # 构建包含历史上下文的提示词
-        context = "之前的对话：\n"
-        if self.chat_history:
-            for msg in self.chat_history[-3:]:  # 只使用最近的3轮对话作为上下文
-                context += f"{msg['role']}: {msg['content']}\n"
-        
-        prompt = f"""
-        {context}
-        基于以下信息生成专业、友好的银行客服回答：
-        
-        用户问题: {state['query']}
-        工具结果: {state['tool_result']}
-        
-        请确保回答：
-        1. 专业且准确
-        2. 语气友好
-        3. 结构清晰
-        4. 考虑对话上下文
-        5. 如有必要，提供后续建议
-        """
-        
-        response = self.model_tool.query(prompt)
+        prompt = self._build_response_prompt(state)
+        response = await self.model_tool.query(prompt, system=RESPONSE_SYSTEM_PROMPT)
         state["response"] = response
         
-        # 更新对话历史
-        self.chat_history.append({"role": "user", "content": state["query"]})
-        self.chat_history.append({"role": "assistant", "content": response})
+        await self._update_history(state["query"], response)
+        return state
+    
+    def _build_response_prompt(self, state: AgentState) -> str:
+        """构建生成最终回答的提示词"""
+        return f"之前的对话：\n{self.history_str}用户问题: {state['query']}\n工具结果: {state['tool_result']}"
+    
+    async def _update_history(self, query: str, response: str) -> None:
+        """更新对话历史，并在写入时维护格式化后的上下文字符串"""
+        for message in (
+            {"role": "user", "content": query},
+            {"role": "assistant", "content": response}
+        ):
+            self.chat_history.append(message)
+            self.history_str += f"{message['role']}: {message['content']}\n"
         
-        # 保持对话历史在合理长度
-        if len(self.chat_history) > 10:  # 保留最近5轮对话
-            self.chat_history = self.chat_history[-10:]
+        # 对话历史只追加，超过 2N 条后将较早的消息压缩为摘要、只保留最近 N 条，
+        # 避免每轮滑动窗口导致提示词前缀变化，同时不丢失早期对话的信息
+        if len(self.chat_history) > 2 * HISTORY_WINDOW:
+            await self._summarize_history(self.chat_history[:-HISTORY_WINDOW])
+            self.chat_history = self.chat_history[-HISTORY_WINDOW:]
+            self.history_str = f"对话摘要: {self.summary}\n" if self.summary else ""
+            self.history_str += "".join(
+                f"{msg['role']}: {msg['content']}\n" for msg in self.chat_history
+            )
+    
+    async def _summarize_history(self, messages: List[Dict[str, str]]) -> None:
+        """将即将移出窗口的消息与已有摘要合并为新的摘要"""
+        dialogue = "".join(f"{msg['role']}: {msg['content']}\n" for msg in messages)
+        if self.summary:
+            dialogue = f"此前的对话摘要: {self.summary}\n{dialogue}"
         
-        return state
+        try:
+            response = await self.model_tool.chat_completion(
+                messages=[{"role": "user", "content": f"请用不超过200字总结以下对话:\n{dialogue}"}],
+                max_tokens=400
+            )
+            self.summary = self.model_tool.get_completion_content(response)
+        except Exception as e:
+            # 摘要失败时保留原有摘要，仅丢弃较早的消息
+            logger.error(f"总结对话历史失败: {str(e)}")
     
     @traceable(name="chat", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def chat(self, query: str) -> str:
+    async def chat(self, query: str) -> str:
         """处理用户查询"""
         try:
-            state: AgentState = {
-                "query": query,
-                "chat_history": self.chat_history,
-                "tool_choice": None,
-                "tool_result": None,
-                "response": None
-            }
-            final_state = self.workflow.invoke(state)
+            state: AgentState = {**self._state_template, "query": query}
+            final_state = await self.workflow.ainvoke(state)
             return final_state["response"]
         except Exception as e:
             logger.error(f"处理查询时出错: {str(e)}")
-            return "抱歉，处理您的请求时出现了错误。请稍后再试或联系人工客服。" 
\ No newline at end of file
+            return ERROR_RESPONSE
+    
+    async def chat_stream(self, query: str) -> AsyncIterator[str]:
+        """处理用户查询，并以流式方式逐段返回最终回答
+        
+        不使用 traceable 装饰：其异步生成器包装不会把 aclose() 传递给内部生成器，
+        中途关闭时无法及时释放模型连接并记录对话历史。工具选择等步骤仍各自有追踪
+        """
+        try:
+            state: AgentState = {**self._state_template, "query": query}
+            state = await self.tool_workflow.ainvoke(state)
+            
+            if state["tool_choice"] == "MODEL" and state["tool_result"]:
+                # 模型在分析阶段已直接给出完整回答，直接输出，不再重复生成一遍
+                await self._update_history(query, state["tool_result"])
+                yield state["tool_result"]
+                return
+            
+            chunks = []
+            prompt = self._build_response_prompt(state)
+            stream = self.model_tool.stream_query(prompt, system=RESPONSE_SYSTEM_PROMPT)
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                await stream.aclose()
+                # 输出被中途关闭时也记录已生成的部分，避免这一轮对话从历史中丢失
+                await self._update_history(query, "".join(chunks))
+        except Exception as e:
+            logger.error(f"处理查询时出错: {str(e)}")
+            yield ERROR_RESPONSE 
\ No newline at end of file
@@ -3,6 +3,9 @@ Streamlit应用界面
 """
 import os
 import sys
+import asyncio
+import hashlib
+import threading
 from pathlib import Path
 
 # 添加项目根目录到Python路径
@@ -11,6 +14,7 @@ if project_root not in sys.path:
     sys.path.append(project_root)
 
 import streamlit as st
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 from loguru import logger
 from langsmith import Client
 
@@ -20,7 +24,9 @@ from langsmith import Client
 #     os.environ["CUDA_VISIBLE_DEVICES"] = ""  # 强制使用CPU
 
 from src.agent import BankServiceAgent
+from src.tools import RAGTool, ModelTool, WebSearchTool
 from src.config import (
+    setup_logging,
     validate_config,
     LANGCHAIN_API_KEY,
     LANGCHAIN_PROJECT,
@@ -38,6 +44,7 @@ def initialize_langsmith():
         os.environ["LANGCHAIN_PROJECT"] = LANGCHAIN_PROJECT
         os.environ["LANGCHAIN_ENDPOINT"] = LANGCHAIN_ENDPOINT
         
+        # LangSmith 客户端默认已在后台线程中批量上报追踪数据，无需额外设置
         client = Client()
         logger.info("成功初始化 LangSmith")
         return client
@@ -45,14 +52,83 @@ def initialize_langsmith():
         logger.error(f"初始化 LangSmith 失败: {str(e)}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """创建在后台线程中常驻的事件循环
+    
+    异步客户端的连接池绑定在创建连接的事件循环上，所有请求都在同一个循环中执行，
+    才能跨请求复用连接；每次 asyncio.run 新建循环会使已有连接失效。
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """在后台事件循环中执行协程并等待结果"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def _anext(agen):
+    """获取异步生成器的下一个元素"""
+    return await agen.__anext__()
+
+def iter_async(agen):
+    """将异步生成器转换为同步生成器，供 st.write_stream 使用
+    
+    脚本中途被打断（重新运行或新的输入）时同样关闭异步生成器，释放模型的流式连接
+    """
+    try:
+        while True:
+            try:
+                yield run_async(_anext(agen))
+            except StopAsyncIteration:
+                break
+    finally:
+        run_async(agen.aclose())
+
+@st.cache_resource(show_spinner=False)
+def get_tools():
+    """初始化所有会话共享的工具，嵌入模型和 API 客户端在每个进程中只创建一次
+    
+    返回的 RAGTool 只用于共享嵌入模型，不持有索引
+    """
+    setup_logging()
+    validate_config()
+    # 初始化 LangSmith
+    initialize_langsmith()
+    model_tool = ModelTool()
+    # 知识库工具与智能体共用同一个模型工具，进程中只有一个 API 客户端和响应缓存
+    return RAGTool(model_tool=model_tool), model_tool, WebSearchTool()
+
+def _file_digest(file: UploadedFile) -> str:
+    """按文件内容计算摘要，作为向量存储的缓存键"""
+    return hashlib.sha256(file.getvalue()).hexdigest()
+
+# 最多缓存 16 组文档的索引，并在 1 小时后过期，避免索引在进程中无限累积；
+# 构建失败时抛出异常，异常不会被缓存，重新点击即可重试
+@st.cache_resource(
+    show_spinner=False,
+    hash_funcs={UploadedFile: _file_digest},
+    max_entries=16,
+    ttl=3600
+)
+def build_vector_store(files):
+    """构建新的向量索引，相同内容的文档重复上传时直接复用已有结果
+    
+    只使用共享的嵌入模型，不修改任何共享工具；索引由调用方保存到自己的会话中
+    """
+    return get_tools()[0].build_store(files)
+
 def initialize_agent():
     """初始化智能体"""
     if "agent" not in st.session_state:
         try:
-            validate_config()
-            # 初始化 LangSmith
-            initialize_langsmith()
-            st.session_state.agent = BankServiceAgent()
+            rag_tool, model_tool, web_search_tool = get_tools()
+            # 对话历史和知识库索引按会话隔离，嵌入模型和 API 客户端在会话之间共享
+            st.session_state.agent = BankServiceAgent(
+                rag_tool=RAGTool(shared=rag_tool),
+                model_tool=model_tool,
+                web_search_tool=web_search_tool
+            )
             logger.info("成功初始化智能体")
         except Exception as e:
             logger.error(f"初始化失败: {str(e)}")
@@ -117,7 +193,7 @@ with st.sidebar:
     
     status_placeholder = st.empty()
     # 显示知识库状态
-    if "agent" in st.session_state and st.session_state.agent.rag_tool.vector_store:
+    if "agent" in st.session_state and st.session_state.agent.rag_tool.store is not None:
         status_placeholder.success("✅ 知识库已加载")
     else:
         status_placeholder.warning("⚠️ 知识库未加载，请上传文档")
@@ -134,7 +210,9 @@ with st.sidebar:
         if st.button("处理上传的文档"):
             with st.spinner("正在处理文档..."):
                 try:
-                    result = st.session_state.agent.rag_tool.load_documents(uploaded_files)
+                    store, result = build_vector_store(uploaded_files)
+                    if store is not None:
+                        st.session_state.agent.rag_tool.store = store
                     st.success(result)
                 except Exception as e:
                     st.error(f"处理文档失败: {str(e)}")
@@ -174,8 +252,8 @@ if prompt := st.chat_input("请输入您的问题"):
     with st.chat_message("assistant"):
         with st.spinner("思考中..."):
             try:
-                response = st.session_state.agent.chat(prompt)
-                st.markdown(response)
+                # 流式输出回答，首个片段生成后即可显示
+                response = st.write_stream(iter_async(st.session_state.agent.chat_stream(prompt)))
                 st.session_state.messages.append({"role": "assistant", "content": response})
             except Exception as e:
                 error_msg = f"处理请求时出错: {str(e)}"
@@ -2,6 +2,7 @@
 配置模块，负责加载和管理配置信息
 """
 import os
+from functools import lru_cache
 from pathlib import Path
 import torch
 from dotenv import load_dotenv
@@ -16,7 +17,6 @@ DATA_DIR = BASE_DIR / "data"
 LOGS_DIR = BASE_DIR / "logs"
 
 # 创建必要的目录
-LOGS_DIR.mkdir(exist_ok=True)
 DATA_DIR.mkdir(exist_ok=True)
 
 # API配置
@@ -37,9 +37,35 @@ PROXY_PORT = os.getenv("PROXY_PORT")
 MODEL_NAME = "BAAI/bge-small-en"
 
 # 设备配置
-DEVICE = "cpu"
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MODEL_KWARGS = {"device": DEVICE}
-ENCODE_KWARGS = {"normalize_embeddings": True}
+if DEVICE == "cuda":
+    # GPU 上使用 BF16 权重，减少显存占用和带宽
+    MODEL_KWARGS["model_kwargs"] = {"torch_dtype": torch.bfloat16}
+# CPU 推理线程配置，使矩阵运算用满所有核心
+torch.set_num_threads(os.cpu_count() or 1)
+try:
+    torch.set_num_interop_threads(2)
+except RuntimeError:
+    # 并行任务启动后无法再修改（例如模块被重新导入），保留当前设置
+    pass
+# 在支持 AVX-512-BF16/AMX 的 CPU 上可开启 BF16 自动混合精度
+CPU_AUTOCAST_BF16 = os.getenv("CPU_AUTOCAST_BF16", "false").lower() == "true"
+ENCODE_KWARGS = {
+    "batch_size": 64,
+    "convert_to_numpy": True,
+    "normalize_embeddings": True,
+    "show_progress_bar": False
+}
+
+# 向量索引配置
+HNSW_M = 32  # HNSW 图中每个节点的邻居数
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVFPQ_MIN_VECTORS = 50000  # 片段数量达到该值时改用 IVF-PQ 压缩索引
+IVFPQ_M = 48  # 乘积量化的子向量数量，需要整除向量维度
+IVFPQ_NBITS = 8
+IVF_NPROBE = 16
 
 # 安全配置
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -52,16 +78,29 @@ LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
 # 缓存配置
 CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))
 
-# 配置日志
-logger.add(
-    LOGS_DIR / "app.log",
-    rotation="500 MB",
-    retention="10 days",
-    level=LOG_LEVEL
-)
+# 日志文件输出的句柄，避免重复添加
+_log_handler_id = None
+
+def setup_logging():
+    """配置日志文件输出
+    
+    由应用启动时显式调用一次，而不是在导入时执行，
+    避免 Streamlit 重新导入模块时重复添加日志文件输出。
+    """
+    global _log_handler_id
+    if _log_handler_id is not None:
+        return
+    LOGS_DIR.mkdir(exist_ok=True)
+    _log_handler_id = logger.add(
+        LOGS_DIR / "app.log",
+        rotation="500 MB",
+        retention="10 days",
+        level=LOG_LEVEL
+    )
 
+@lru_cache(maxsize=None)
 def validate_config():
-    """验证必要的配置是否存在"""
+    """验证必要的配置是否存在，结果在进程内缓存"""
     # 基础服务配置验证
     required_vars = [
         ("DEEPSEEK_API_KEY", DEEPSEEK_API_KEY),
@@ -104,17 +143,15 @@ def validate_config():
             logger.warning(f"代理端口格式错误: {PROXY_PORT}")
     
     # 返回验证结果
-    return {
+    config_status = {
         "base_config": len(missing_vars) == 0,
         "google_api": len(missing_google) == 0,
         "proxy": len(missing_proxy) == 0
     }
-
-# 验证配置
-config_status = validate_config()
-
-# 输出配置状态
-logger.info("配置验证结果:")
-logger.info(f"基础配置: {'✓' if config_status['base_config'] else '✗'}")
-logger.info(f"Google API: {'✓' if config_status['google_api'] else '✗'}")
-logger.info(f"代理配置: {'✓' if config_status['proxy'] else '✗'}") 
\ No newline at end of file
+    
+    # 输出配置状态
+    logger.info("配置验证结果:")
+    logger.info(f"基础配置: {'✓' if config_status['base_config'] else '✗'}")
+    logger.info(f"Google API: {'✓' if config_status['google_api'] else '✗'}")
+    logger.info(f"代理配置: {'✓' if config_status['proxy'] else '✗'}")
+    return config_status
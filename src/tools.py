@@ -1,78 +1,136 @@
 """
 工具模块，包含所有可用的工具实现
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
+from collections import OrderedDict
+import asyncio
+import hashlib
+import io
+import threading
 import numpy as np
 import requests
 from pathlib import Path
 import faiss
 from sentence_transformers import SentenceTransformer
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.docstore.document import Document
 from langchain.embeddings.base import Embeddings
 from langsmith.run_helpers import traceable
 from loguru import logger
 import torch
 import json
 import time
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-import httplib2
-from openai import OpenAI
+import httpx
+from pypdf import PdfReader
+from openai import AsyncOpenAI
 
 from src.config import (
     MODEL_NAME,
     MODEL_KWARGS,
     ENCODE_KWARGS,
+    DEVICE,
+    CPU_AUTOCAST_BF16,
     DEEPSEEK_API_KEY,
     DATA_DIR,
     GOOGLE_API_KEY,
     GOOGLE_CSE_ID,
     PROXY_HOST,
     PROXY_PORT,
-    LANGCHAIN_PROJECT
+    LANGCHAIN_PROJECT,
+    CACHE_TTL,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    IVFPQ_MIN_VECTORS,
+    IVFPQ_M,
+    IVFPQ_NBITS,
+    IVF_NPROBE
 )
 
+GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+
+DEFAULT_SYSTEM_PROMPT = "你是一个专业的银行客服助手，请用专业、友好的语气回答用户的问题。"
+
 class CustomEmbeddings(Embeddings):
     """自定义嵌入类，包装 SentenceTransformer"""
     
     def __init__(self, model: SentenceTransformer):
         self.model = model
+        self.autocast_enabled = CPU_AUTOCAST_BF16 and DEVICE == "cpu"
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """批量生成归一化的嵌入矩阵"""
+        with torch.inference_mode(), torch.autocast(
+            "cpu", dtype=torch.bfloat16, enabled=self.autocast_enabled
+        ):
+            return self.model.encode(texts, **ENCODE_KWARGS)
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """生成文档嵌入"""
-        with torch.no_grad():
-            embeddings = self.model.encode(texts, **ENCODE_KWARGS)
-        return embeddings.tolist()
+        return self.encode(texts).tolist()
     
     def embed_query(self, text: str) -> List[float]:
         """生成查询嵌入"""
-        with torch.no_grad():
-            embedding = self.model.encode([text], **ENCODE_KWARGS)[0]
-        return embedding.tolist()
+        return self.encode([text])[0].tolist()
 
 class RAGTool:
     """基于RAG的知识库文档工具"""
     
-    def __init__(self):
-        try:
-            logger.info(f"正在初始化模型，使用设备: {MODEL_KWARGS['device']}")
-            self.model = SentenceTransformer(MODEL_NAME, **MODEL_KWARGS)
-            self.embeddings = CustomEmbeddings(self.model)
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=500,
-                chunk_overlap=50
-            )
-            self.vector_store = None
-            self.model_tool = ModelTool()  # 用于生成最终答案
-        except Exception as e:
-            logger.error(f"初始化模型失败: {str(e)}")
-            raise
+    def __init__(
+        self,
+        shared: Optional["RAGTool"] = None,
+        model_tool: Optional["ModelTool"] = None
+    ):
+        """
+        Args:
+            shared: 共享其嵌入模型和模型工具的实例，索引仍由每个实例单独持有
+            model_tool: 用于生成答案的模型工具，传入后与调用方共用 API 客户端和响应缓存
+        """
+        self._shared = shared
+        # 嵌入模型和模型工具在首次使用时才加载，未使用知识库时不占用内存
+        self._model = None
+        self._embeddings = None
+        self._model_tool = model_tool
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=500,
+            chunk_overlap=50
+        )
+        # (FAISS 索引, 与索引中向量一一对应的文档片段)，整体替换以保证两者始终匹配
+        self.store: Optional[Tuple[faiss.Index, List[str]]] = None
+    
+    @property
+    def model(self) -> SentenceTransformer:
+        """嵌入模型，首次访问时加载"""
+        if self._shared is not None:
+            return self._shared.model
+        if self._model is None:
+            try:
+                logger.info(f"正在初始化模型，使用设备: {MODEL_KWARGS['device']}")
+                self._model = SentenceTransformer(MODEL_NAME, **MODEL_KWARGS)
+            except Exception as e:
+                logger.error(f"初始化模型失败: {str(e)}")
+                raise
+        return self._model
+    
+    @property
+    def embeddings(self) -> CustomEmbeddings:
+        """嵌入封装，首次访问时创建"""
+        if self._shared is not None:
+            return self._shared.embeddings
+        if self._embeddings is None:
+            self._embeddings = CustomEmbeddings(self.model)
+        return self._embeddings
+    
+    @property
+    def model_tool(self) -> "ModelTool":
+        """用于生成最终答案的模型工具，未传入时首次访问才创建"""
+        if self._model_tool is None and self._shared is not None:
+            return self._shared.model_tool
+        if self._model_tool is None:
+            self._model_tool = ModelTool()
+        return self._model_tool
     
-    @traceable(name="load_documents", run_type="chain", project_name=LANGCHAIN_PROJECT)
     def load_documents(self, files: List[Any]) -> str:
-        """加载文档并创建向量存储
+        """加载文档并替换当前实例的向量存储
         
         Args:
             files: 上传的文件列表
@@ -81,43 +139,128 @@ class RAGTool:
             str: 处理结果信息
         """
         try:
-            documents = []
-            for file in files:
-                try:
-                    # 读取文件内容
-                    text = file.getvalue().decode("utf-8")
-                    # 分割文本
-                    chunks = self.text_splitter.split_text(text)
-                    documents.extend([Document(page_content=chunk) for chunk in chunks])
-                    logger.info(f"成功处理文件: {file.name}")
-                except Exception as e:
-                    logger.error(f"处理文件 {file.name} 失败: {str(e)}")
-                    continue
-            
-            if documents:
-                logger.info(f"开始创建文档嵌入，共 {len(documents)} 个文档片段")
-                
-                # 使用自定义嵌入类创建向量存储
-                self.vector_store = FAISS.from_documents(documents, self.embeddings)
-                logger.info("成功创建向量存储")
-                return f"成功加载 {len(documents)} 个文档片段"
-            else:
-                return "没有找到可处理的文档内容"
-                
+            store, result = self.build_store(files)
         except Exception as e:
             error_msg = f"处理文档时出错: {str(e)}"
             logger.error(error_msg)
             return error_msg
+        
+        if store is not None:
+            self.store = store
+        return result
+    
+    @traceable(name="load_documents", run_type="chain", project_name=LANGCHAIN_PROJECT)
+    def build_store(
+        self, files: List[Any]
+    ) -> Tuple[Optional[Tuple[faiss.Index, List[str]]], str]:
+        """加载文档并创建新的向量存储，不修改当前实例的状态
+        
+        Args:
+            files: 上传的文件列表
+            
+        Returns:
+            Tuple: (索引和文档片段，没有可处理的内容时为 None, 处理结果信息)
+            
+        Raises:
+            Exception: 加载模型、编码或构建索引失败时直接抛出，便于调用方区分失败与空结果
+        """
+        texts = []
+        for file in files:
+            try:
+                # 读取文件内容
+                texts.append(self._read_text(file))
+                logger.info(f"成功处理文件: {file.name}")
+            except Exception as e:
+                logger.error(f"处理文件 {file.name} 失败: {str(e)}")
+                continue
+        
+        # 一次性分割所有文件的文本
+        documents = self.text_splitter.create_documents(texts)
+        
+        if not documents:
+            return None, "没有找到可处理的文档内容"
+        
+        logger.info(f"开始创建文档嵌入，共 {len(documents)} 个文档片段")
+        
+        # 一次性批量编码所有片段，直接用现成的嵌入构建近似最近邻索引
+        texts = [doc.page_content for doc in documents]
+        embeddings = self.embeddings.encode(texts)
+        index = self._build_index(embeddings)
+        logger.info("成功创建向量存储")
+        return (index, texts), f"成功加载 {len(documents)} 个文档片段"
+    
+    def _read_text(self, file: Any) -> str:
+        """以流的方式读取上传文件的文本内容，避免额外复制整个文件
+        
+        Args:
+            file: 上传的文件对象
+            
+        Returns:
+            str: 文件文本
+        """
+        file.seek(0)
+        if file.name.lower().endswith(".pdf"):
+            reader = PdfReader(file)
+            return "\n".join(page.extract_text() or "" for page in reader.pages)
+        
+        wrapper = io.TextIOWrapper(file, encoding="utf-8")
+        try:
+            return wrapper.read()
+        finally:
+            # 解除包装，避免关闭底层的上传文件对象
+            wrapper.detach()
     
-    def _format_relevant_docs(self, docs: List[Document]) -> str:
+    def _build_index(self, embeddings: np.ndarray) -> faiss.Index:
+        """构建向量索引
+        
+        默认使用 HNSW 图索引，检索复杂度约为 O(log N)；
+        片段数量很大时改用 IVF-PQ，通过乘积量化压缩内存占用。
+        
+        Args:
+            embeddings: 归一化后的文档嵌入矩阵
+            
+        Returns:
+            faiss.Index: 已添加全部向量的索引
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        count, dim = embeddings.shape
+        
+        if count >= IVFPQ_MIN_VECTORS and dim % IVFPQ_M == 0:
+            nlist = int(np.sqrt(count))
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, IVFPQ_M, IVFPQ_NBITS)
+            index.train(embeddings)
+            index.nprobe = IVF_NPROBE
+            logger.info(f"使用 IVF-PQ 索引，nlist={nlist}")
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+            logger.info(f"使用 HNSW 索引，M={HNSW_M}")
+        
+        index.add(embeddings)
+        return index
+    
+    def _format_relevant_docs(self, docs: List[str]) -> str:
         """格式化相关文档片段"""
         formatted_docs = []
         for i, doc in enumerate(docs, 1):
-            formatted_docs.append(f"片段 {i}:\n{doc.page_content}\n")
+            formatted_docs.append(f"片段 {i}:\n{doc}\n")
         return "\n".join(formatted_docs)
     
+    def _search(self, question: str, k: int) -> List[str]:
+        """编码问题并在 FAISS 索引中检索最相关的文档片段"""
+        # 先取出同一时刻的索引和文档，避免检索过程中被新上传的文档替换
+        index, docs = self.store
+        question_embedding = self.embeddings.encode([question])
+        _, indices = index.search(
+            np.ascontiguousarray(question_embedding, dtype=np.float32), k
+        )
+        # 索引中的向量少于 k 个时，FAISS 用 -1 填充结果
+        return [docs[i] for i in indices[0] if i != -1]
+    
     @traceable(name="query_rag", run_type="chain", project_name=LANGCHAIN_PROJECT)
-    def query(self, question: str, k: int = 4) -> str:
+    async def query(self, question: str, k: int = 4) -> str:
         """查询知识库并生成答案
         
         Args:
@@ -127,13 +270,15 @@ class RAGTool:
         Returns:
             str: 生成的答案
         """
-        if not self.vector_store:
+        if self.store is None:
             return "知识库为空，请先上传并处理文档"
         
         try:
-            # 第一阶段：使用 embedding 进行相似度搜索
+            # 第一阶段：使用 embedding 进行相似度搜索，直接调用 FAISS 索引
             logger.info(f"正在搜索相关文档: {question}")
-            relevant_docs = self.vector_store.similarity_search(question, k=k)
+            # 编码和检索是 CPU 密集操作，放到线程池中执行，避免阻塞事件循环
+            loop = asyncio.get_running_loop()
+            relevant_docs = await loop.run_in_executor(None, self._search, question, k)
             
             if not relevant_docs:
                 return "未找到相关文档"
@@ -162,7 +307,7 @@ class RAGTool:
             """
             
             logger.info("正在生成答案")
-            answer = self.model_tool.query(prompt)
+            answer = await self.model_tool.query(prompt)
             logger.info("成功生成答案")
             
             return answer
@@ -172,39 +317,196 @@ class RAGTool:
             logger.error(error_msg)
             return error_msg
 
+class ResponseCache:
+    """带过期时间的 LRU 响应缓存，以请求内容的 SHA-256 摘要为键"""
+    
+    def __init__(self, maxsize: int = 1024, ttl: int = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """根据请求内容生成缓存键"""
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存，过期或不存在时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: Any) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
 class ModelTool:
     """DeepSeek模型调用工具"""
     
     def __init__(self):
         """初始化 DeepSeek API 配置"""
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             api_key=DEEPSEEK_API_KEY,
             base_url="https://api.deepseek.com"
         )
+        # 仅缓存 temperature=0 的确定性请求，相同请求直接复用结果
+        self.cache = ResponseCache()
     
     @traceable(name="query_model", run_type="llm", project_name=LANGCHAIN_PROJECT)
-    def query(self, prompt: str) -> str:
-        """调用模型API"""
+    async def query(
+        self,
+        prompt: str,
+        system: str = DEFAULT_SYSTEM_PROMPT,
+        temperature: float = 0.7
+    ) -> str:
+        """调用模型API
+        
+        Args:
+            prompt: 用户提示词
+            system: 系统提示词，保持不变的指令应放在这里以便命中提示词缓存
+            temperature: 温度参数，为 0 时结果会被缓存
+            
+        Returns:
+            str: 模型回答
+        """
         try:
+            cache_key = None
+            if temperature == 0:
+                cache_key = ResponseCache.make_key(system, prompt, "deepseek-chat", temperature)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    logger.info("命中模型响应缓存")
+                    return cached
+            
             messages = [
-                {"role": "system", "content": "你是一个专业的银行客服助手，请用专业、友好的语气回答用户的问题。"},
+                {"role": "system", "content": system},
                 {"role": "user", "content": prompt}
             ]
             
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model="deepseek-chat",
                 messages=messages,
-                temperature=0.7,
+                temperature=temperature,
                 max_tokens=2000
             )
             
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+            return content
             
         except Exception as e:
             logger.error(f"调用模型API失败: {str(e)}")
             return f"调用模型失败: {str(e)}"
     
-    def chat_completion(
+    async def stream_query(
+        self,
+        prompt: str,
+        system: str = DEFAULT_SYSTEM_PROMPT,
+        temperature: float = 0.7
+    ) -> AsyncIterator[str]:
+        """以流式方式调用模型API，逐段返回生成的内容
+        
+        Args:
+            prompt: 用户提示词
+            system: 系统提示词
+            temperature: 温度参数
+            
+        Yields:
+            str: 生成内容的增量片段
+        
+        与 chat_stream 相同，不使用 traceable 装饰，保证 aclose() 能立即关闭响应
+        """
+        try:
+            messages = [
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt}
+            ]
+            
+            stream = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                temperature=temperature,
+                max_tokens=2000,
+                stream=True
+            )
+            
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                # 调用方提前停止读取时关闭响应，释放连接
+                await stream.close()
+                    
+        except Exception as e:
+            logger.error(f"调用模型API失败: {str(e)}")
+            yield f"调用模型失败: {str(e)}"
+    
+    @traceable(name="query_model_with_tools", run_type="llm", project_name=LANGCHAIN_PROJECT)
+    async def query_with_tools(
+        self,
+        prompt: str,
+        tools: List[Dict[str, Any]],
+        system: str = DEFAULT_SYSTEM_PROMPT,
+        temperature: float = 0
+    ) -> Any:
+        """调用模型API，并允许模型通过函数调用选择工具
+        
+        Args:
+            prompt: 用户提示词
+            tools: 函数调用定义列表
+            system: 系统提示词
+            temperature: 温度参数，为 0 时结果会被缓存
+            
+        Returns:
+            模型返回的消息对象，包含 content 和 tool_calls
+        """
+        try:
+            cache_key = None
+            if temperature == 0:
+                cache_key = ResponseCache.make_key(system, prompt, tools, "deepseek-chat", temperature)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    logger.info("命中模型响应缓存")
+                    return cached
+            
+            messages = [
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt}
+            ]
+            
+            response = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                tools=tools,
+                temperature=temperature,
+                max_tokens=2000
+            )
+            
+            message = response.choices[0].message
+            if cache_key is not None:
+                self.cache.set(cache_key, message)
+            return message
+            
+        except Exception as e:
+            logger.error(f"调用模型API失败: {str(e)}")
+            raise
+    
+    async def chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: str = "deepseek-chat",
@@ -237,7 +539,7 @@ class ModelTool:
             if max_tokens is not None:
                 params["max_tokens"] = max_tokens
                 
-            response = self.client.chat.completions.create(**params)
+            response = await self.client.chat.completions.create(**params)
             return response
             
         except Exception as e:
@@ -260,28 +562,21 @@ class WebSearchTool:
     """网络搜索工具"""
     
     def __init__(self):
-        """初始化Google Custom Search API服务"""
+        """初始化Google Custom Search API客户端"""
         try:
-            # 创建支持代理的 HTTP 对象
-            proxy_info = None
+            proxy = None
             if PROXY_HOST and PROXY_PORT:
-                proxy_info = httplib2.ProxyInfo(
-                    proxy_type=httplib2.socks.PROXY_TYPE_HTTP,
-                    proxy_host=PROXY_HOST,
-                    proxy_port=int(PROXY_PORT)
-                )
+                proxy = f"http://{PROXY_HOST}:{PROXY_PORT}"
                 logger.info(f"使用代理设置: {PROXY_HOST}:{PROXY_PORT}")
             
-            http = httplib2.Http(
-                proxy_info=proxy_info,
-                timeout=30
-            )
-            
-            # 创建 Google API 客户端
-            self.service = build(
-                "customsearch", "v1",
-                developerKey=GOOGLE_API_KEY,
-                http=http
+            # 使用连接池并启用 HTTP/2，重复搜索时复用已建立的 TCP/TLS 连接
+            self.client = httpx.AsyncClient(
+                http2=True,
+                timeout=30,
+                proxy=proxy,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                # API 密钥放在请求头中，不会出现在 URL 及其错误信息里
+                headers={"X-Goog-Api-Key": GOOGLE_API_KEY or ""}
             )
             logger.info("成功初始化 Google 搜索服务")
         except Exception as e:
@@ -289,7 +584,7 @@ class WebSearchTool:
             raise
     
     @traceable(name="web_search", run_type="tool", project_name=LANGCHAIN_PROJECT)
-    def search(self, query: str, num_results: int = 5) -> str:
+    async def search(self, query: str, num_results: int = 5) -> str:
         """执行网络搜索
         
         Args:
@@ -303,11 +598,16 @@ class WebSearchTool:
             logger.info(f"开始执行搜索: {query}")
             
             # 执行搜索
-            result = self.service.cse().list(
-                q=query,
-                cx=GOOGLE_CSE_ID,
-                num=num_results
-            ).execute()
+            response = await self.client.get(
+                GOOGLE_SEARCH_URL,
+                params={
+                    "q": query,
+                    "cx": GOOGLE_CSE_ID,
+                    "num": num_results
+                }
+            )
+            response.raise_for_status()
+            result = response.json()
             
             # 格式化结果
             if "items" not in result:
@@ -324,10 +624,10 @@ class WebSearchTool:
             logger.info(f"搜索成功，找到 {len(formatted_results)} 条结果")
             return "\n".join(formatted_results)
             
-        except HttpError as e:
-            error_msg = f"Google搜索API调用失败: {str(e)}"
+        except httpx.HTTPStatusError as e:
+            error_msg = f"Google搜索API调用失败: HTTP {e.response.status_code}"
             logger.error(error_msg)
-            return f"搜索失败: {str(e)}"
+            return f"搜索失败: HTTP {e.response.status_code}"
         except Exception as e:
             error_msg = f"执行搜索时出错: {str(e)}"
             logger.error(error_msg)
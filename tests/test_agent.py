@@ -0,0 +1,91 @@
+"""
+测试智能体的流式输出
+"""
+import asyncio
+import json
+from pathlib import Path
+import sys
+from types import SimpleNamespace
+
+# 添加项目根目录到 Python 路径
+project_root = str(Path(__file__).parent.parent)
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from src.agent import BankServiceAgent
+from src.tools import ModelTool
+
+class FakeStream:
+    """模拟 DeepSeek 的流式响应，记录是否被关闭"""
+    
+    def __init__(self, contents):
+        self.contents = contents
+        self.requested = False
+        self.closed = False
+    
+    async def __aiter__(self):
+        for content in self.contents:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+    
+    async def close(self):
+        self.closed = True
+
+class FakeRAGTool:
+    """返回固定结果的知识库工具"""
+    
+    async def query(self, question: str) -> str:
+        return "知识库内容"
+
+def make_agent(monkeypatch, stream, direct_answer=None):
+    """创建使用模拟客户端的智能体
+    
+    Args:
+        stream: 生成最终回答时返回的流式响应
+        direct_answer: 不为 None 时模型直接回答，否则选择查询知识库
+    """
+    monkeypatch.setattr("src.tools.DEEPSEEK_API_KEY", "test-key")
+    model_tool = ModelTool()
+    
+    async def create(**kwargs):
+        stream.requested = True
+        return stream
+    model_tool.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    
+    async def query_with_tools(prompt, tools, system=None, temperature=0):
+        if direct_answer is not None:
+            return SimpleNamespace(tool_calls=None, content=direct_answer)
+        function = SimpleNamespace(name="query_knowledge_base", arguments=json.dumps({"query": "问题"}))
+        return SimpleNamespace(tool_calls=[SimpleNamespace(function=function)], content=None)
+    model_tool.query_with_tools = query_with_tools
+    
+    return BankServiceAgent(rag_tool=FakeRAGTool(), model_tool=model_tool, web_search_tool=object())
+
+def test_chat_stream_aclose(monkeypatch):
+    """中途关闭流式输出时，应立即关闭模型响应并记录已生成的部分"""
+    stream = FakeStream(["您好", "，", "请问"])
+    agent = make_agent(monkeypatch, stream)
+    
+    async def run():
+        agen = agent.chat_stream("问题")
+        assert await agen.__anext__() == "您好"
+        await agen.aclose()
+        # 必须在事件循环关闭前检查，循环关闭时会统一回收未关闭的异步生成器
+        assert stream.closed
+        assert agent.chat_history == [
+            {"role": "user", "content": "问题"},
+            {"role": "assistant", "content": "您好"}
+        ]
+    
+    asyncio.run(run())
+
+def test_chat_stream_direct_answer(monkeypatch):
+    """模型直接回答时，应复用分析阶段的回答，不再发起第二次生成"""
+    stream = FakeStream(["不应输出"])
+    agent = make_agent(monkeypatch, stream, direct_answer="直接回答")
+    
+    async def run():
+        return [chunk async for chunk in agent.chat_stream("问题")]
+    
+    assert asyncio.run(run()) == ["直接回答"]
+    assert not stream.requested
+    assert agent.chat_history[-1] == {"role": "assistant", "content": "直接回答"}
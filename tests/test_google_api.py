@@ -2,6 +2,7 @@
 测试 Google API 的可用性
 """
 import os
+import asyncio
 from pathlib import Path
 import sys
 
@@ -32,7 +33,7 @@ def test_google_api():
         test_query = "中国工商银行最新存款利率"
         print(f"\n执行测试搜索：{test_query}")
         
-        result = search_tool.search(test_query, num_results=2)
+        result = asyncio.run(search_tool.search(test_query, num_results=2))
         print("\n搜索结果：")
         print(result)
         
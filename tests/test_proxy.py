@@ -4,10 +4,16 @@
 import os
 import sys
 from pathlib import Path
+import certifi
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import NewConnectionError
+from requests_futures.sessions import FuturesSession
 import socket
 import time
 import json
+import re
 from loguru import logger
 from dotenv import load_dotenv
 
@@ -15,162 +21,343 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # 获取代理配置
-PROXY_HOST = os.getenv("PROXY_HOST", "127.0.0.1")
-PROXY_PORT = os.getenv("PROXY_PORT", "7890")
+PROXY_HOST = os.environ.get("PROXY_HOST", "127.0.0.1")
+PROXY_PORT = os.environ.get("PROXY_PORT", "7890")
 
-def verify_response_content(response):
-    """验证响应内容是否真的来自 Google"""
+# 导入时校验代理配置，测试函数中不再重复检查
+if not PROXY_HOST or not PROXY_PORT:
+    raise RuntimeError("代理配置未设置，请在 .env 文件中设置 PROXY_HOST 和 PROXY_PORT")
+try:
+    PROXY_PORT_INT = int(PROXY_PORT)
+except ValueError:
+    raise RuntimeError(f"PROXY_PORT 必须是整数: {PROXY_PORT}") from None
+
+# DNS 解析缓存: 主机名 -> (IP, 解析时间)
+_DNS_CACHE = {}
+
+def resolve_cached(host, ttl=900):
+    """解析主机名，结果在 ttl 秒内复用
+    
+    解析失败时抛出 socket.gaierror，且不写入缓存
+    """
+    cached = _DNS_CACHE.get(host)
+    if cached and time.time() - cached[1] < ttl:
+        return cached[0]
+    
+    ip = socket.gethostbyname(host)
+    _DNS_CACHE[host] = (ip, time.time())
+    return ip
+
+def resolve_proxy_ip():
+    """解析代理主机的 IP，解析失败时直接使用原主机名"""
+    try:
+        return resolve_cached(PROXY_HOST)
+    except socket.gaierror:
+        return PROXY_HOST
+
+def build_proxies(proxy_ip):
+    """用代理 IP 构造代理配置，请求时不再为代理主机做 DNS 解析"""
+    proxy_url = f"http://{proxy_ip}:{PROXY_PORT_INT}"
+    return {
+        'http': proxy_url,
+        'https': proxy_url
+    }
+
+# 导入时解析一次代理主机
+PROXY_IP = resolve_proxy_ip()
+PROXIES = build_proxies(PROXY_IP)
+
+def get_proxies():
+    """返回当前的代理配置，DNS 缓存过期后重新解析代理主机"""
+    global PROXY_IP, PROXIES
+    proxy_ip = resolve_proxy_ip()
+    if proxy_ip != PROXY_IP:
+        PROXY_IP = proxy_ip
+        PROXIES = build_proxies(proxy_ip)
+    return PROXIES
+
+# 共享的 HTTP 会话，连接池保持 TLS 连接，重复请求时无需重新握手；
+# 对连接失败和网关错误进行指数退避重试，避免偶发故障直接耗尽整个超时时间
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=2,
+        connect=2,
+        backoff_factor=0.25,
+        status_forcelist=(502, 503, 504),
+        respect_retry_after_header=False
+    )
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+SESSION.headers["Connection"] = "keep-alive"
+# 证书包在会话上设置一次，所有请求都会验证 SSL 证书
+SESSION.verify = certifi.where()
+
+# 请求超时：(连接超时, 读取超时)
+REQUEST_TIMEOUT = (3, 5)
+
+# 基于共享会话的线程池会话，代理请求和直连请求可以同时发出
+FUTURES = FuturesSession(session=SESSION, max_workers=2)
+
+# 代理检查默认只发 HEAD 请求，传入 --full 时下载页面做完整检查
+FULL_CHECK = "--full" in sys.argv
+PROXY_CHECK_METHOD = 'GET' if FULL_CHECK else 'HEAD'
+
+# Google 页面特征关键词，直接在响应字节上匹配
+_GOOGLE_RE = re.compile(rb'google|search', re.IGNORECASE)
+
+def read_body_head(response, limit=8192):
+    """只读取响应体开头的 limit 字节，验证页面特征不需要完整内容
+    
+    读取后立即关闭响应，不再下载剩余内容。通过 iter_content 读取，
+    读取超时等底层错误会被转换为 requests 的异常
+    """
+    try:
+        return next(response.iter_content(limit), b"")
+    finally:
+        response.close()
+
+def fetch_google(proxies=None, method='GET'):
+    """在线程池中请求 Google 首页，立即返回 future
+    
+    响应体开头和耗时在工作线程中读取，分别保存在 response.body_head
+    和 response.elapsed_time 上
+    
+    Args:
+        proxies: 代理配置，None 表示直接连接
+        method: 请求方法，HEAD 请求不传输响应体
+    """
+    start_time = time.perf_counter()
+    
+    def read_head(response, *args, **kwargs):
+        # 重定向的中间响应交给 requests 自己处理
+        if response.is_redirect:
+            return
+        response.body_head = read_body_head(response)
+        response.elapsed_time = time.perf_counter() - start_time
+    
+    return FUTURES.request(
+        method,
+        'https://www.google.com',
+        proxies=proxies,
+        timeout=REQUEST_TIMEOUT,
+        allow_redirects=True,
+        stream=True,
+        hooks={'response': read_head}
+    )
+
+def is_port_closed(error):
+    """判断连接错误是否因为无法与代理端口建立 TCP 连接
+    
+    SSL 错误、隧道建立失败（如代理返回 403）等情况说明代理端口是开放的，返回 False
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    
+    # urllib3 把底层原因层层包装在 reason、original_error 或 args 中
+    pending = [error]
+    seen = set()
+    while pending:
+        exc = pending.pop()
+        if id(exc) in seen:
+            continue
+        seen.add(id(exc))
+        if isinstance(exc, (NewConnectionError, ConnectionRefusedError)):
+            return True
+        candidates = [
+            getattr(exc, 'reason', None),
+            getattr(exc, 'original_error', None),
+            exc.__cause__,
+            exc.__context__,
+            *exc.args
+        ]
+        pending.extend(c for c in candidates if isinstance(c, BaseException))
+    return False
+
+def log_response_info(response, elapsed_time, body):
+    """一次性输出响应信息"""
+    logger.info("\n".join([
+        "\n响应信息:",
+        f"状态码: {response.status_code}",
+        f"响应时间: {elapsed_time:.2f}秒",
+        f"已读取: {len(body)} 字节",
+        f"服务器: {response.headers.get('Server', 'Unknown')}",
+        f"内容类型: {response.headers.get('Content-Type', 'Unknown')}"
+    ]))
+
+def verify_response_content(headers, body, headers_only=False):
+    """验证响应内容是否真的来自 Google
+    
+    只依赖响应头和响应体字节，不绑定具体的 HTTP 客户端。
+    先检查代价低的特征，结果已经确定时不再扫描响应体
+    
+    Args:
+        headers: 响应头
+        body: 响应体开头的字节
+        headers_only: 只有响应头时（HEAD 请求），要求服务器和内容类型都符合
+    """
     try:
         # 检查响应头
-        server = response.headers.get('Server', '').lower()
-        content_type = response.headers.get('Content-Type', '').lower()
+        server = headers.get('Server', '').lower()
+        content_type = headers.get('Content-Type', '').lower()
         
-        # 检查响应内容
-        content = response.text.lower()
+        if headers_only:
+            # Google 的 Server 头通常是 gws
+            return ('google' in server or server.startswith('gws')) and 'html' in content_type
         
-        # Google 特征检查
-        google_indicators = [
+        # Google 特征检查：共 5 项，至少满足 60% 的特征
+        total = 5
+        required = total * 0.6
+        hits = sum([
             'google' in server,
             'html' in content_type,
-            'google' in content,
-            'search' in content,
-            len(content) > 1000  # Google 首页通常很大
-        ]
+            len(body) > 1000  # Google 首页通常很大
+        ])
+        remaining = 2  # 响应体中的 google / search 两个关键词
+        
+        if hits >= required:
+            return True
+        if hits + remaining < required:
+            return False
+        
+        # 检查响应内容：一次扫描找出出现过的关键词，两个都找到后立即停止
+        found = set()
+        for match in _GOOGLE_RE.finditer(body):
+            found.add(match.group().lower())
+            if len(found) == 2:
+                break
         
-        success_rate = sum(google_indicators) / len(google_indicators)
-        return success_rate >= 0.6  # 至少满足60%的特征
+        return hits + len(found) >= required
     except Exception as e:
-        print(f"验证响应内容时出错: {str(e)}")
+        logger.error(f"验证响应内容时出错: {str(e)}")
         return False
 
-def test_proxy_connection():
-    """测试代理服务器连接"""
-    if not PROXY_HOST or not PROXY_PORT:
-        print("错误：代理配置未设置")
-        print("请在 .env 文件中设置 PROXY_HOST 和 PROXY_PORT")
-        return False
+def test_proxy_connection(future=None):
+    """测试代理服务器连接
     
-    print(f"\n正在测试代理连接: {PROXY_HOST}:{PROXY_PORT}")
+    Args:
+        future: 已发出的代理请求，为 None 时在此处发起
+    """
+    logger.info(f"\n正在测试代理连接: {PROXY_HOST}:{PROXY_PORT}")
     
-    # 测试代理服务器端口是否开放
+    # 通过代理访问 Google，端口是否开放由同一个请求的连接结果判断，
+    # 不再单独建立一次 TCP 连接探测端口
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        result = sock.connect_ex((PROXY_HOST, int(PROXY_PORT)))
-        sock.close()
+        logger.info("\n正在通过代理访问 Google...")
+        logger.info(f"使用代理设置: {json.dumps(get_proxies(), indent=2)}")
         
-        if result != 0:
-            print(f"❌ 代理端口未开放: {PROXY_HOST}:{PROXY_PORT}")
+        if future is None:
+            future = fetch_google(get_proxies(), PROXY_CHECK_METHOD)
+        try:
+            response = future.result()
+            if response.status_code == 405 and response.request.method == 'HEAD':
+                # 不支持 HEAD 时退回 GET
+                response = fetch_google(get_proxies()).result()
+        except requests.exceptions.ConnectionError as e:
+            # 只有无法建立 TCP 连接时才算端口未开放，其余错误按访问失败处理
+            if not is_port_closed(e):
+                raise
+            logger.error(f"❌ 代理端口未开放: {PROXY_HOST}:{PROXY_PORT} ({str(e)})")
             return False
-        else:
-            print(f"✅ 代理端口已开放: {PROXY_HOST}:{PROXY_PORT}")
-    except Exception as e:
-        print(f"❌ 测试代理端口时出错: {str(e)}")
-        return False
-
-    # 测试通过代理访问 Google
-    try:
-        proxies = {
-            'http': f'http://{PROXY_HOST}:{PROXY_PORT}',
-            'https': f'http://{PROXY_HOST}:{PROXY_PORT}'
-        }
-        
-        print("\n正在通过代理访问 Google...")
-        print(f"使用代理设置: {json.dumps(proxies, indent=2)}")
-        
-        start_time = time.time()
-        response = requests.get(
-            'https://www.google.com',
-            proxies=proxies,
-            timeout=10,
-            verify=True  # 验证 SSL 证书
-        )
-        elapsed_time = time.time() - start_time
+        logger.info(f"✅ 代理端口已开放: {PROXY_HOST}:{PROXY_PORT}")
+        body = response.body_head
         
-        print(f"\n响应信息:")
-        print(f"状态码: {response.status_code}")
-        print(f"响应时间: {elapsed_time:.2f}秒")
-        print(f"响应大小: {len(response.content)} 字节")
-        print(f"服务器: {response.headers.get('Server', 'Unknown')}")
-        print(f"内容类型: {response.headers.get('Content-Type', 'Unknown')}")
+        log_response_info(response, response.elapsed_time, body)
         
-        if response.status_code == 200 and verify_response_content(response):
-            print(f"\n✅ 成功访问 Google！")
+        headers_only = response.request.method == 'HEAD'
+        if response.status_code == 200 and verify_response_content(response.headers, body, headers_only):
+            logger.info(f"\n✅ 成功访问 Google！")
             return True
         else:
-            print(f"\n❌ 访问 Google 失败或响应内容异常")
+            logger.error(f"\n❌ 访问 Google 失败或响应内容异常")
             return False
             
     except requests.exceptions.RequestException as e:
-        print(f"❌ 通过代理访问 Google 时出错: {str(e)}")
+        logger.error(f"❌ 通过代理访问 Google 时出错: {str(e)}")
         return False
 
-def test_direct_connection():
-    """测试直接连接（不使用代理）"""
-    print("\n正在测试直接连接...")
+def test_direct_connection(future=None):
+    """测试直接连接（不使用代理）
+    
+    Args:
+        future: 已发出的直连请求，为 None 时在此处发起
+    """
+    logger.info("\n正在测试直接连接...")
     try:
         # 首先测试 DNS 解析
         try:
-            print("正在解析 www.google.com...")
-            ip = socket.gethostbyname('www.google.com')
-            print(f"DNS 解析结果: {ip}")
+            logger.info("正在解析 www.google.com...")
+            ip = resolve_cached('www.google.com')
+            logger.info(f"DNS 解析结果: {ip}")
         except socket.gaierror as e:
-            print(f"❌ DNS 解析失败: {str(e)}")
+            logger.error(f"❌ DNS 解析失败: {str(e)}")
             return False
             
-        start_time = time.time()
-        response = requests.get('https://www.google.com', timeout=5)
-        elapsed_time = time.time() - start_time
+        if future is None:
+            future = fetch_google()
+        response = future.result()
+        body = response.body_head
         
-        print(f"\n响应信息:")
-        print(f"状态码: {response.status_code}")
-        print(f"响应时间: {elapsed_time:.2f}秒")
-        print(f"响应大小: {len(response.content)} 字节")
-        print(f"服务器: {response.headers.get('Server', 'Unknown')}")
-        print(f"内容类型: {response.headers.get('Content-Type', 'Unknown')}")
+        log_response_info(response, response.elapsed_time, body)
         
-        if response.status_code == 200 and verify_response_content(response):
-            print(f"\n✅ 直接连接成功！")
+        if response.status_code == 200 and verify_response_content(response.headers, body):
+            logger.info(f"\n✅ 直接连接成功！")
             return True
         else:
-            print(f"\n❌ 直接连接失败或响应内容异常")
+            logger.error(f"\n❌ 直接连接失败或响应内容异常")
             return False
     except requests.exceptions.RequestException as e:
-        print(f"❌ 直接连接失败: {str(e)}")
+        logger.error(f"❌ 直接连接失败: {str(e)}")
         return False
 
 def main():
     """主函数"""
-    print("=== 代理连接测试 ===")
-    print(f"Python 版本: {sys.version}")
-    print(f"Requests 版本: {requests.__version__}")
+    # 日志通过后台线程写出，避免逐行输出阻塞测试
+    logger.remove()
+    logger.add(sys.stderr, enqueue=True, level="INFO", format="{message}")
     
-    proxy_result = test_proxy_connection()
+    logger.info("\n".join([
+        "=== 代理连接测试 ===",
+        f"Python 版本: {sys.version}",
+        f"Requests 版本: {requests.__version__}"
+    ]))
     
-    print("\n=== 直接连接测试 ===")
-    direct_result = test_direct_connection()
+    logger.info("\n=== 代理连接 / 直接连接测试（并发执行）===")
+    # 先同时发出两个请求，总耗时取两者中较慢的一个
+    proxy_future = fetch_google(get_proxies(), PROXY_CHECK_METHOD)
+    direct_future = fetch_google()
+    proxy_result = test_proxy_connection(proxy_future)
+    direct_result = test_direct_connection(direct_future)
     
-    print("\n=== 测试总结 ===")
+    logger.info("\n=== 测试总结 ===")
     if proxy_result:
-        print("✅ 代理连接正常工作")
+        logger.info("✅ 代理连接正常工作")
     else:
-        print("❌ 代理连接测试失败")
+        logger.error("❌ 代理连接测试失败")
         
     if direct_result:
-        print("✅ 直接连接正常工作")
+        logger.info("✅ 直接连接正常工作")
     else:
-        print("❌ 直接连接测试失败")
+        logger.error("❌ 直接连接测试失败")
         
     if not proxy_result and not direct_result:
-        print("\n⚠️ 建议：")
-        print("1. 检查网络连接是否正常")
-        print("2. 确认代理服务器是否正在运行")
-        print("3. 验证代理配置是否正确")
-        print("4. 尝试重启代理服务器")
-        print("5. 检查防火墙设置")
-        print("6. 尝试使用其他代理端口")
-        print("7. 检查代理软件是否支持 HTTPS 代理")
-        print("8. 验证代理服务器是否支持 Google 域名")
+        logger.warning("\n".join([
+            "\n⚠️ 建议：",
+            "1. 检查网络连接是否正常",
+            "2. 确认代理服务器是否正在运行",
+            "3. 验证代理配置是否正确",
+            "4. 尝试重启代理服务器",
+            "5. 检查防火墙设置",
+            "6. 尝试使用其他代理端口",
+            "7. 检查代理软件是否支持 HTTPS 代理",
+            "8. 验证代理服务器是否支持 Google 域名"
+        ]))
+    
+    # 等待后台线程写完所有日志
+    logger.complete()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file